@@ -18,41 +18,105 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
 from .spline import BSpline, BSplineBasis
-from casadi import SX, MX, mtimes, Function, vertcat
+from casadi import SX, MX, DM, mtimes, Function, vertcat, solve, sparsify
+from bisect import insort
+from collections import namedtuple
+from functools import lru_cache
+from weakref import WeakKeyDictionary
+from scipy import interpolate
 from scipy.interpolate import splev
 import scipy.linalg as la
 import numpy as np
 
 import warnings
 
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional: without it the kernels below run as plain Python
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda fun: fun
+
+# The *_T transformation matrices only depend on the knots and degree of the
+# (immutable, instance-cached) basis, so they are memoized on the basis
+# object itself. This removes the linear solves and Python loops from the
+# every-iteration path in receding horizon problems.
+
+_BasisMeta = namedtuple('_BasisMeta', ['N', 'mult_right', 'greville',
+                                       'knot_diffs'])
+_basis_meta_cache = WeakKeyDictionary()
+
+
+def _basis_meta(basis):
+    # Per-basis metadata that several transformations would otherwise
+    # recompute on every call: basis length, multiplicity of the repeating
+    # internal end knots, greville abscissae and the degree+1 spaced knot
+    # differences (the integration weights).
+    meta = _basis_meta_cache.get(basis)
+    if meta is None:
+        knots, deg = basis.knots, basis.degree
+        mult_right = (len(knots)-deg-1 -
+                      np.searchsorted(knots, knots[-deg-2], side='left'))
+        meta = _BasisMeta(len(basis), mult_right,
+                          np.asarray(basis.greville()),
+                          knots[deg+1:] - knots[:-(deg+1)])
+        _basis_meta_cache[basis] = meta
+    return meta
+
+def _eval_active_basis(knots, degree, i0, x):
+    # Evaluate the degree+1 basis functions that are nonzero on knot interval
+    # [knots[i0], knots[i0+1]] via the local Cox-de Boor recursion. Returns
+    # [N_{i0-degree,degree}(x), ..., N_{i0,degree}(x)]; works for numeric and
+    # symbolic x.
+    b = [1.]
+    for d in range(1, degree + 1):
+        b_new = [0.]*(d + 1)
+        for r in range(d):
+            j = i0 - d + 1 + r
+            bottom = knots[j + d] - knots[j]
+            if bottom != 0:
+                w = (x - knots[j])/bottom
+                b_new[r] += (1. - w)*b[r]
+                b_new[r + 1] += w*b[r]
+        b = b_new
+    return b
+
+
 def evalspline(s, x):
     # Evaluate spline with symbolic variable
-    # This is possible not the best way to implement this. The conditional node
-    # from casadi should be considered
+    # Only the degree+1 basis functions supported on the active knot interval
+    # are nonzero, so the Cox-de Boor recursion is restricted to those. This
+    # keeps the expression graph small when x is symbolic.
     Bl = s.basis
     coeffs = s.coeffs
-    k = Bl.knots
-    basis = [[]]
-    for i in range(len(k) - 1):
-        if i < Bl.degree + 1 and Bl.knots[0] == Bl.knots[i]:
-            basis[-1].append((x >= Bl.knots[i])*(x <= Bl.knots[i + 1]))
-        else:
-            basis[-1].append((x > Bl.knots[i])*(x <= Bl.knots[i + 1]))
-    for d in range(1, Bl.degree + 1):
-        basis.append([])
-        for i in range(len(k) - d - 1):
-            b = 0 * x
-            bottom = k[i + d] - k[i]
-            if bottom != 0:
-                b = (x - k[i]) * basis[d - 1][i] / bottom
-            bottom = k[i + d + 1] - k[i + 1]
-            if bottom != 0:
-                b += (k[i + d + 1] - x) * basis[d - 1][i + 1] / bottom
-            basis[-1].append(b)
-    result = 0.
-    for l in range(len(Bl)):
-        result += mtimes(coeffs[l], basis[-1][l])
-    return result
+    knots = Bl.knots
+    deg = Bl.degree
+    if isinstance(x, (SX, MX)):
+        # the active interval is unknown: evaluate the local polynomial on
+        # each non-empty interval and select it with an indicator function.
+        # With sorted knots the indicator of the right-closed interval
+        # (knots[i0], knots[i0+1]] is the difference of two step functions,
+        # so each comparison is emitted once and shared between neighbouring
+        # intervals instead of forming a comparison product per interval.
+        ivals = [i0 for i0 in range(deg, len(knots) - deg - 1)
+                 if knots[i0] != knots[i0 + 1]]
+        steps = [x >= knots[deg]] + [x > knots[i0 + 1] for i0 in ivals]
+        result = 0.
+        for j, i0 in enumerate(ivals):
+            b = _eval_active_basis(knots, deg, i0, x)
+            local = sum([coeffs[i0 - deg + r]*b[r] for r in range(deg + 1)])
+            result += (steps[j] - steps[j + 1])*local
+        return result
+    if np.asarray(x).ndim > 0:
+        return s(x)
+    # numeric scalar: locate the active interval directly; intervals are
+    # right-closed (cfr. Basis._ind), so take the one ending at x
+    i0 = min(max(np.searchsorted(knots, x, side='left') - 1, deg),
+             len(Bl) - 1)
+    b = _eval_active_basis(knots, deg, i0, x)
+    return sum([coeffs[i0 - deg + r]*b[r] for r in range(deg + 1)])
 
 
 def running_integral(spline):
@@ -65,24 +129,42 @@ def running_integral(spline):
     knots_int = np.r_[knots[0], knots, knots[-1]]
     degree_int = degree + 1
     basis_int = BSplineBasis(knots_int, degree_int)
-    coeffs_int = [0.]
-    for i in range(len(basis_int)-1):
-        coeffs_int.append(coeffs_int[i]+(knots[degree+i+1]-knots[i])/float(degree_int)*coeffs[i])
+    # coeffs_int is a prefix sum of the weighted coefficients
+    w = _basis_meta(basis).knot_diffs/float(degree_int)
     if isinstance(coeffs, (MX, SX)):
-        coeffs_int = vertcat(*coeffs_int)
+        W = np.tril(np.ones((len(w), len(w))))*w
+        coeffs_int = vertcat(0., mtimes(W, coeffs))
     else:
-        coeffs_int = np.array(coeffs_int)
+        coeffs_int = np.r_[0., np.cumsum(w*np.asarray(coeffs))]
     spline_int = BSpline(basis_int, coeffs_int)
     return spline_int
 
 
+@lru_cache(maxsize=256)
+def _definite_integral_row(basis, a, b):
+    # Row vector q such that the definite integral over [a, b] of a spline
+    # in basis equals q.dot(coeffs): the integrated basis evaluated in b
+    # minus a, pushed through the running-integral weight matrix.
+    knots = basis.knots
+    degree = basis.degree
+    basis_int = BSplineBasis(np.r_[knots[0], knots, knots[-1]], degree+1)
+    w = _basis_meta(basis).knot_diffs/float(degree+1)
+    db = basis_int.eval_basis(np.array([a, b])).toarray()
+    q = db[1] - db[0]
+    return np.cumsum(q[:0:-1])[::-1]*w
+
+
 def definite_integral(spline, a, b):
     # Compute definite integral of spline in interval [a, b]
-    spline_int = running_integral(spline)
-    int_0a = evalspline(spline_int, a)
-    int_0b = evalspline(spline_int, b)
-    int_ab = int_0b - int_0a
-    return int_ab
+    if isinstance(a, (SX, MX)) or isinstance(b, (SX, MX)):
+        spline_int = running_integral(spline)
+        return evalspline(spline_int, b) - evalspline(spline_int, a)
+    # numeric bounds: collapse the integrated-spline evaluations into a
+    # single (cached) coefficient contraction
+    q = _definite_integral_row(spline.basis, float(a), float(b))
+    if isinstance(spline.coeffs, (SX, MX)):
+        return mtimes(q.reshape((1, -1)), spline.coeffs)
+    return q.dot(spline.coeffs)
 
 
 def shift_spline(coeffs, t_shift, basis):
@@ -99,41 +181,133 @@ def shift_spline(coeffs, t_shift, basis):
     return T_tf.dot(coeffs)
 
 
+def _as_dm(T):
+    # Wrap a numeric transformation matrix as a casadi DM constant,
+    # structurally sparse when that pays off, so that mtimes with symbolic
+    # coefficients does not convert the full array on every call.
+    T = np.asarray(T)
+    dm = DM(T)
+    if np.count_nonzero(T) <= 0.25*T.size:
+        dm = sparsify(dm)
+    return dm
+
+
 def extrapolate(coeffs, t_extra, basis):
+    if isinstance(coeffs, (SX, MX)):
+        return mtimes(_extrapolate_T_dm(basis, float(t_extra)), coeffs)
     T = extrapolate_T(basis, t_extra)
     return T.dot(coeffs)
 
 
+@lru_cache(maxsize=256)
+def _extrapolate_T_dm(basis, t_extra):
+    return _as_dm(_extrapolate_T(basis, t_extra))
+
+
 def extrapolate_T(basis, t_extra):
+    return _extrapolate_T(basis, float(t_extra))
+
+
+@lru_cache(maxsize=256)
+def _extrapolate_T(basis, t_extra):
     # Create transformation matrix that extrapolates the spline over an extra
     # knot interval of t_extra long.
     knots = basis.knots
     deg = basis.degree
-    N = len(basis)
-    m = 1  # number of repeating internal knots
-    while knots[-deg-2-m] >= knots[-deg-2]:
-        m += 1
+    meta = _basis_meta(basis)
+    N = meta.N
+    m = meta.mult_right  # number of repeating internal knots
     knots2 = np.r_[knots[:-deg-1], knots[-deg-1]*np.ones(m),
                    (knots[-1]+t_extra)*np.ones(deg+1)]
     basis2 = BSplineBasis(knots2, deg)
-    A = np.zeros((deg+1, deg+1))
-    B = np.zeros((deg+1, deg+1))
-    # (deg+1-m) relations based on evaluation of basis functions on (deg+1-m)
-    # last greville points
+    _T = None
     if m < deg+1:
-        eval_points = basis.greville()[-(deg+1-m):]
-        a = basis2.eval_basis(eval_points).toarray()[:, -(deg+1+m):-m]
-        b = basis.eval_basis(eval_points).toarray()[:, -(deg+1):]
-        a1, a2 = a[:, :m], a[:, m:]
-        b1, b2 = b[:, :m], b[:, m:]
-        A[:(deg+1-m), -(deg+1):-m] = a2
-        B[:(deg+1-m), :m] = b1 - a1  # this should be zeros
-        B[:(deg+1-m), m:] = b2
-    else:
-        A[0, -(deg+1)] = 1.
-        B[0, -1] = 1.
-    # m relations based on continuity of m last derivatives
-    A1, B1 = np.identity(deg+1), np.identity(deg+1)
+        # closed-form value relations from the knot ratios alone; verified
+        # against cheap invariants with the evaluation-based path as backup
+        ab = _extrapolate_T_refine(basis, basis2, deg, N, m)
+        if ab is not None:
+            A = np.zeros((deg+1, deg+1))
+            B = np.zeros((deg+1, deg+1))
+            A[:deg+1-m, :], B[:deg+1-m, :] = ab
+            # m relations based on continuity of m last derivatives
+            _extrapolate_T_core(np.ascontiguousarray(knots),
+                                np.ascontiguousarray(knots2), deg, N, m,
+                                A, B)
+            _T = np.linalg.solve(A, B)
+            if not _extrapolate_T_check(_T, basis, basis2, deg):
+                _T = None
+    if _T is None:
+        A = np.zeros((deg+1, deg+1))
+        B = np.zeros((deg+1, deg+1))
+        # (deg+1-m) relations based on evaluation of basis functions on
+        # (deg+1-m) last greville points
+        if m < deg+1:
+            eval_points = meta.greville[-(deg+1-m):]
+            # slice the sparse evaluation first, only the small block is
+            # densified
+            a = basis2.eval_basis(eval_points)[:, -(deg+1+m):-m].toarray()
+            b = basis.eval_basis(eval_points)[:, -(deg+1):].toarray()
+            a1, a2 = a[:, :m], a[:, m:]
+            b1, b2 = b[:, :m], b[:, m:]
+            A[:(deg+1-m), -(deg+1):-m] = a2
+            B[:(deg+1-m), :m] = b1 - a1  # this should be zeros
+            B[:(deg+1-m), m:] = b2
+        else:
+            A[0, -(deg+1)] = 1.
+            B[0, -1] = 1.
+        # m relations based on continuity of m last derivatives
+        _extrapolate_T_core(np.ascontiguousarray(knots),
+                            np.ascontiguousarray(knots2), deg, N, m, A, B)
+        _T = np.linalg.solve(A, B)
+    # put everything in transformation matrix
+    _T[abs(_T) < 1e-10] = 0.
+    T = np.zeros((N+m, N))
+    T[:N, :N] = np.eye(N)
+    T[-(deg+1):, -(deg+1):] = _T
+    return T
+
+
+def _extrapolate_T_refine(basis, basis2, deg, N, m):
+    # Closed-form overlap relations via knot insertion (the Oslo algorithm):
+    # inserting the old end knot deg+1-m times into the extrapolated basis
+    # refines it into the old clamped basis extended with the extrapolation
+    # segment, so requiring the refined coefficients to reproduce the old
+    # ones yields the deg+1-m value relations from knot ratios alone,
+    # without any basis evaluation. Returns the corresponding rows of
+    # (A, B), or None when the construction does not apply.
+    t_end = basis.knots[-deg-1]
+    if basis.knots[-1] != t_end:
+        return None  # basis is not clamped at the end
+    K, _ = knot_insertion_T(basis2, [t_end]*(deg+1-m))
+    q = N + m - deg - 1  # index of the first transformed new coefficient
+    A_rows = K[q:N, q:]
+    B_rows = np.zeros((deg+1-m, deg+1))
+    Kk = K[q:N, :q]
+    for r in range(deg+1-m):
+        B_rows[r, q+r-(N-deg-1)] = 1.
+    for r, i in zip(*np.nonzero(abs(Kk) > 1e-14)):
+        if i < N-deg-1:
+            return None  # depends on coefficients outside the block
+        B_rows[r, i-(N-deg-1)] -= Kk[r, i]
+    return A_rows, B_rows
+
+
+def _extrapolate_T_check(_T, basis, basis2, deg):
+    # cheap invariants: constant and linear splines extrapolate exactly,
+    # i.e. partition of unity and reproduction of the greville abscissae
+    if not np.allclose(_T.sum(axis=1), 1., atol=1e-8):
+        return False
+    g_old = _basis_meta(basis).greville[-(deg+1):]
+    g_new = _basis_meta(basis2).greville[-(deg+1):]
+    return np.allclose(_T.dot(g_old), g_new, atol=1e-8)
+
+
+@njit(cache=True, fastmath=True)
+def _extrapolate_T_core(knots, knots2, deg, N, m, A, B):
+    # Fill the derivative-continuity rows of A and B in-place. Pure numeric
+    # scalar loops, kept free of basis/casadi objects so numba can compile
+    # them.
+    A1, B1 = np.eye(deg+1), np.eye(deg+1)
     for i in range(1, deg+1):
         A1_tmp = np.zeros((deg+1-i, deg+1-i+1))
         B1_tmp = np.zeros((deg+1-i, deg+1-i+1))
@@ -142,35 +316,32 @@ def extrapolate_T(basis, t_extra):
             B1_tmp[j, j+1] = (deg+1-i)/(knots[j+N] - knots[j+N-deg-1+i])
             A1_tmp[j, j] = -(deg+1-i)/(knots2[j+N+m] - knots2[j+N-deg-1+m+i])
             A1_tmp[j, j+1] = (deg+1-i)/(knots2[j+N+m] - knots2[j+N-deg-1+m+i])
-        A1, B1 = A1_tmp.dot(A1), B1_tmp.dot(B1)
+        A1, B1 = np.dot(A1_tmp, A1), np.dot(B1_tmp, B1)
         if i >= deg+1-m:
-            b1 = B1[-1, :]
-            a1 = A1[-(deg-i+1), :]
-            A[i, :] = a1
-            B[i, :] = b1
-    # put everything in transformation matrix
-    _T = np.linalg.solve(A, B)
-    _T[abs(_T) < 1e-10] = 0.
-    T = np.zeros((N+m, N))
-    T[:N, :N] = np.eye(N)
-    T[-(deg+1):, -(deg+1):] = _T
-    return T
+            A[i, :] = A1[-(deg-i+1), :]
+            B[i, :] = B1[-1, :]
 
 
 def shift_over_knot(coeffs, basis):
+    if isinstance(coeffs, (SX, MX)):
+        return mtimes(_shiftoverknot_T_dm(basis), coeffs)
     T = shiftoverknot_T(basis)
     return T.dot(coeffs)
 
 
+@lru_cache(maxsize=256)
+def _shiftoverknot_T_dm(basis):
+    return _as_dm(shiftoverknot_T(basis))
+
+
+@lru_cache(maxsize=256)
 def shiftoverknot_T(basis):
     # Create transformation matrix that moves the horizon to
     # [knot[degree+1], T+knots[-1]-knots[-deg-2]]. The spline is extrapolated
     # over the last knot interval.
     knots = basis.knots
     deg = basis.degree
-    m = 1  # number of repeating internal knots
-    while knots[-deg-2-m] >= knots[-deg-2]:
-        m += 1
+    m = _basis_meta(basis).mult_right  # number of repeating internal knots
     t_shift = knots[deg+1] - knots[0]
     T = np.diag(np.ones(len(basis)-m), m)
     _T = np.eye(deg+1)
@@ -191,13 +362,34 @@ def shiftoverknot_T(basis):
     return T
 
 
-def shift_knot1_fwd(cfs, basis, t_shift):
-    if isinstance(cfs, (SX, MX)):
-        cfs_sym = MX.sym('cfs', cfs.shape)
-        t_shift_sym = MX.sym('t_shift')
-        T = shiftfirstknot_T(basis, t_shift_sym)
+# Function construction and .expand() are among the most expensive casadi
+# operations; the functions below only depend on the basis, the coefficient
+# shape and the shift direction, so they are cached across the iterations
+# of a receding horizon problem.
+_shift_fun_cache = {}
+
+
+def _shift_knot1_fun(basis, shape, fwd):
+    key = (basis, shape, fwd)
+    if key not in _shift_fun_cache:
+        typ = MX if fwd else SX
+        cfs_sym = typ.sym('cfs', shape)
+        t_shift_sym = typ.sym('t_shift')
+        if fwd:
+            T = shiftfirstknot_T(basis, t_shift_sym)
+        else:
+            _, T = shiftfirstknot_T(basis, t_shift_sym, inverse=True)
         cfs2_sym = mtimes(T, cfs_sym)
         fun = Function('fun', [cfs_sym, t_shift_sym], [cfs2_sym]).expand()
+        _shift_fun_cache[key] = fun
+    return _shift_fun_cache[key]
+
+
+def shift_knot1_fwd(cfs, basis, t_shift):
+    if not isinstance(t_shift, (SX, MX)) and float(t_shift) == 0.:
+        return cfs  # step is aligned with a knot: nothing to shift
+    if isinstance(cfs, (SX, MX)):
+        fun = _shift_knot1_fun(basis, (cfs.shape[0], cfs.shape[1]), True)
         return fun(cfs, t_shift)
     else:
         T = shiftfirstknot_T(basis, t_shift)
@@ -205,12 +397,10 @@ def shift_knot1_fwd(cfs, basis, t_shift):
 
 
 def shift_knot1_bwd(cfs, basis, t_shift):
+    if not isinstance(t_shift, (SX, MX)) and float(t_shift) == 0.:
+        return cfs  # step is aligned with a knot: nothing to shift
     if isinstance(cfs, (SX, MX)):
-        cfs_sym = SX.sym('cfs', cfs.shape)
-        t_shift_sym = SX.sym('t_shift')
-        _, Tinv = shiftfirstknot_T(basis, t_shift_sym, inverse=True)
-        cfs2_sym = mtimes(Tinv, cfs_sym)
-        fun = Function('fun', [cfs_sym, t_shift_sym], [cfs2_sym]).expand()
+        fun = _shift_knot1_fun(basis, (cfs.shape[0], cfs.shape[1]), False)
         return fun(cfs, t_shift)
     else:
         _, Tinv = shiftfirstknot_T(basis, t_shift, inverse=True)
@@ -218,6 +408,17 @@ def shift_knot1_bwd(cfs, basis, t_shift):
 
 
 def shiftfirstknot_T(basis, t_shift, inverse=False):
+    if isinstance(t_shift, (SX, MX)):
+        return _shiftfirstknot_T(basis, t_shift, inverse)
+    return _shiftfirstknot_T_cached(basis, float(t_shift), inverse)
+
+
+@lru_cache(maxsize=256)
+def _shiftfirstknot_T_cached(basis, t_shift, inverse):
+    return _shiftfirstknot_T(basis, t_shift, inverse)
+
+
+def _shiftfirstknot_T(basis, t_shift, inverse=False):
     # Create transformation matrix that shifts the first (degree+1) knots over
     # t_shift. With inverse = True, the inverse transformation is also
     # computed.
@@ -229,9 +430,41 @@ def shiftfirstknot_T(basis, t_shift, inverse=False):
         typ, sym = MX, True
     else:
         typ, sym = np, False
-    _T = typ.eye(deg+1)
+    if sym:
+        # the transformed block is polynomial in t_shift: contract the
+        # cached numeric coefficient matrices with powers of t_shift
+        # (Horner), which emits O(deg) matrix nodes instead of O(deg^3)
+        # scalar ones
+        C = _shiftfirstknot_T_poly(basis)
+        _Tb = DM(C[-1])
+        for Ck in C[-2::-1]:
+            _Tb = DM(Ck) + t_shift*_Tb
+    else:
+        _T = _shiftfirstknot_T_core(np.ascontiguousarray(knots), deg,
+                                    float(t_shift))
+        _Tb = _T[deg+1:, :]
+    T = typ.eye(N)
+    T[:deg+1, :deg+1] = _Tb
+    if inverse:  # T is upper triangular: easy inverse
+        Tinv = typ.eye(N)
+        if sym:
+            Tinv[:deg+1, :deg+1] = solve(T[:deg+1, :deg+1], typ.eye(deg+1))
+        else:
+            Tinv[:deg+1, :deg+1] = la.solve_triangular(
+                T[:deg+1, :deg+1], np.eye(deg+1), lower=False)
+        return T, Tinv
+    else:
+        return T
+
+
+@njit(cache=True, fastmath=True)
+def _shiftfirstknot_T_core(knots, deg, t_shift):
+    # Numeric kernel of shiftfirstknot_T: repeated insertion of t_shift in
+    # the first knot interval. The symbolic branch keeps the pure Python
+    # loop, as numba cannot handle casadi types.
+    _T = np.eye(deg+1)
     for k in range(deg+1):
-        _t = typ.zeros((deg+1+k+1, deg+1+k))
+        _t = np.zeros((deg+1+k+1, deg+1+k))
         for j in range(deg+1+k+1):
             if j >= deg+1:
                 _t[j, j-1] = 1.
@@ -240,53 +473,68 @@ def shiftfirstknot_T(basis, t_shift, inverse=False):
             else:
                 _t[j, j-1] = (knots[j+deg-k]-t_shift)/(knots[j+deg-k]-knots[j])
                 _t[j, j] = (t_shift-knots[j])/(knots[j+deg-k]-knots[j])
-        _T = mtimes(_t, _T) if sym else _t.dot(_T)
-    T = typ.eye(N)
-    T[:deg+1, :deg+1] = _T[deg+1:, :]
-    if inverse:  # T is upper triangular: easy inverse
-        Tinv = typ.eye(len(basis))
-        for i in range(deg, -1, -1):
-            Tinv[i, i] = 1./T[i, i]
-            for j in range(deg, i, -1):
-                Tinv[i, j] = (-1./T[i, i])*sum([T[i, k]*Tinv[k, j]
-                                                for k in range(i+1, deg+2)])
-        return T, Tinv
-    else:
-        return T
+        _T = np.dot(_t, _T)
+    return _T
+
+
+@lru_cache(maxsize=256)
+def _shiftfirstknot_T_poly(basis):
+    # The (deg+1)x(deg+1) block of shiftfirstknot_T is a matrix polynomial
+    # of degree deg+1 in t_shift. Recover its numeric coefficient matrices
+    # from evaluations of the numeric kernel at Chebyshev nodes in the first
+    # knot interval.
+    knots, deg = basis.knots, basis.degree
+    n = deg + 2
+    a, b = knots[0], knots[deg+1]
+    nodes = 0.5*(a+b) + 0.5*(b-a)*np.cos(np.pi*(2.*np.arange(n)+1.)/(2.*n))
+    evals = [_shiftfirstknot_T_core(np.ascontiguousarray(knots), deg,
+                                    t)[deg+1:, :] for t in nodes]
+    V = np.vander(nodes, n, increasing=True)
+    C = np.linalg.solve(V, np.reshape(evals, (n, -1)))
+    C[abs(C) < 1e-12] = 0.
+    return C.reshape((n, deg+1, deg+1))
 
 
 def knot_insertion_T(basis, knots_to_insert):
+    return _knot_insertion_T(basis, tuple(knots_to_insert))
+
+
+@lru_cache(maxsize=256)
+def _knot_insertion_T(basis, knots_to_insert):
     # Create transformation matrix that transforms spline after inserting knots
     N = len(basis)
     knots = basis.knots.tolist()
     degree = basis.degree
     T = np.eye(N)
     for knot in knots_to_insert:
-        _T = np.zeros((N+1, N))
-        for j in range(N+1):
-            if knot <= knots[j]:
-                w = 0.
-            elif knots[j] < knot and knot < knots[j+degree+1-1]:
-                w = (knot - knots[j])/(knots[j+degree+1-1] - knots[j])
-            else:
-                w = 1.
-            if j != 0:
-                _T[j, j-1] = (1.-w)
-            if j != N:
-                _T[j, j] = w
-        T = _T.dot(T)
+        # the insertion matrix is banded with at most two nonzeros per row:
+        # apply it as a weighted row combination instead of allocating a
+        # dense (N+1)xN matrix and doing an O(N^2) product per knot
+        lo = np.asarray(knots[:N+1])
+        hi = np.asarray(knots[degree:degree+N+1])
+        w = np.clip((knot - lo)/np.where(hi > lo, hi - lo, 1.), 0., 1.)
+        w[knot >= hi] = 1.
+        w[knot <= lo] = 0.  # takes precedence for zero-length spans
+        _T = np.empty((N+1, T.shape[1]))
+        _T[0] = w[0]*T[0]
+        _T[1:N] = (1.-w[1:N, None])*T[:N-1] + w[1:N, None]*T[1:N]
+        _T[N] = (1.-w[N])*T[N-1]
+        T = _T
         N += 1
-        knots = sorted(knots + [knot])
+        insort(knots, knot)
     return T, knots
 
 
+@lru_cache(maxsize=256)
 def get_interval_T(basis, min_value, max_value):
     # Create transformation matrix that extract piece of spline from min_value
     # to max_value
     knots = basis.knots
     degree = basis.degree
-    n_min = len(np.where(knots == min_value)[0])
-    n_max = len(np.where(knots == max_value)[0])
+    n_min = (np.searchsorted(knots, min_value, side='right') -
+             np.searchsorted(knots, min_value, side='left'))
+    n_max = (np.searchsorted(knots, max_value, side='right') -
+             np.searchsorted(knots, max_value, side='left'))
     min_knots = [min_value]*(degree + 1 - n_min)
     max_knots = [max_value]*(degree + 1 - n_max)
     T, knots2 = knot_insertion_T(basis, min_knots+max_knots)
@@ -295,33 +543,80 @@ def get_interval_T(basis, min_value, max_value):
     return T[jmin:jmax-degree-1, :], knots2[jmin:jmax]
 
 
+@lru_cache(maxsize=256)
+def _get_interval_T_dm(basis, min_value, max_value):
+    return _as_dm(get_interval_T(basis, min_value, max_value)[0])
+
+
 def crop_spline(spline, min_value, max_value):
+    knots = spline.basis.knots
+    deg = spline.basis.degree
+    if (min_value == knots[0] and max_value == knots[-1] and
+            knots[deg] == knots[0] and knots[-deg-1] == knots[-1]):
+        # crop of a clamped basis to its full interval is the identity
+        return spline
     T, knots2 = get_interval_T(spline.basis, min_value, max_value)
     if isinstance(spline.coeffs, (SX, MX)):
-        coeffs2 = mtimes(T, spline.coeffs)
+        coeffs2 = mtimes(_get_interval_T_dm(spline.basis, min_value,
+                                            max_value), spline.coeffs)
     else:
         coeffs2 = T.dot(spline.coeffs)
     basis2 = BSplineBasis(knots2, spline.basis.degree)
     return BSpline(basis2, coeffs2)
 
 
+def _extract_soa(segments):
+    # One pass over the segment splines: extract knots, coefficients and
+    # degrees into component-major lists, so the concatenation loops read
+    # plain arrays instead of going through repeated attribute lookups.
+    # All concatenated splines of a component should be of the same degree;
+    # this is checked here, before any array work.
+    degrees = [s.basis.degree for s in segments[0]]
+    for segment in segments[1:]:
+        for l, s in enumerate(segment):
+            if s.basis.degree != degrees[l]:
+                raise ValueError(
+                    'Splines at index %d should have same degree.' % l)
+    all_knots = [[segment[l].basis.knots for segment in segments]
+                 for l in range(len(segments[0]))]
+    all_coeffs = [[np.asarray(segment[l].coeffs) for segment in segments]
+                  for l in range(len(segments[0]))]
+    return all_knots, all_coeffs, degrees
+
+
+def _concat_splines_stacked(segments, segment_times):
+    # Concatenation without continuity: the output sizes are known up front,
+    # so collect the knot and coefficient pieces of all segments and join
+    # them with a single concatenate per spline component.
+    all_knots, all_coeffs, degree = _extract_soa(segments)
+    splines = []
+    for l in range(len(segments[0])):
+        knot_parts = [all_knots[l][0]*segment_times[0]]
+        for k in range(1, len(segments)):
+            knot_parts.append(all_knots[l][k][degree[l]+1:]*segment_times[k] +
+                              knot_parts[-1][-1])
+        basis = BSplineBasis(np.concatenate(knot_parts), degree[l])
+        splines.append(BSpline(basis, np.concatenate(all_coeffs[l])))
+    return splines
+
+
 def concat_splines(segments, segment_times, n_insert=None):
     # While concatenating check continuity of segments, this determines
     # the required amount of knots to insert. If segments are continuous
     # up to degree, no extra knots are required. If they are not continuous
     # at all, degree+1 knots are inserted in between the splines.
+    if (n_insert is not None and
+            all(n_insert == s.basis.degree+1 for s in segments[0])):
+        return _concat_splines_stacked(segments, segment_times)
     spl0 = segments[0]
-    knots = [s.basis.knots*segment_times[0] for s in spl0]  # give dimensions
-    degree = [s.basis.degree for s in spl0]
-    coeffs = [s.coeffs for s in spl0]
+    all_knots, all_coeffs, degree = _extract_soa(segments)
+    knots = [all_knots[l][0]*segment_times[0]
+             for l in range(len(spl0))]  # give dimensions
+    coeffs = [all_coeffs[l][0] for l in range(len(spl0))]
     prev_segment = [s.scale(segment_times[0], shift=0) for s in spl0]  # save the combined segment until now (with dimenions)
     prev_time = segment_times[0]  # save the motion time of combined segment
     for k in range(1, len(segments)):
         for l, s in enumerate(segments[k]):
-            if s.basis.degree != degree[l]:
-                # all concatenated splines should be of the same degree
-                raise ValueError(
-                    'Splines at index ' + l + 'should have same degree.')
             if n_insert is None:
                 # check continuity, n_insert can be different for each l
                 n_insert = degree[l]+1  # starts at max value
@@ -353,14 +648,14 @@ def concat_splines(segments, segment_times, n_insert=None):
 
                 # make total knot vector
                 end_idx = len(knots[l])-(degree[l]+1)+n_insert
-                knots[l] = np.r_[
-                    knots[l][:end_idx], s.basis.knots[degree[l]+1:]*segment_times[k] + knots[l][-1]]  # last term = time shift
+                knots[l] = np.concatenate((
+                    knots[l][:end_idx], all_knots[l][k][degree[l]+1:]*segment_times[k] + knots[l][-1]))  # last term = time shift
 
                 # make knot vector for two segments to concatenate
                 end_idx_concat = len(prev_segment[l].basis.knots)-(degree[l]+1)+n_insert
                 knots1 = prev_segment[l].basis.knots[:end_idx_concat]
-                knots2 = s.basis.knots[degree[l]+1:]*segment_times[k] + knots1[-1]  # last term = time shift
-                knots_concat = np.r_[knots1, knots2]
+                knots2 = all_knots[l][k][degree[l]+1:]*segment_times[k] + knots1[-1]  # last term = time shift
+                knots_concat = np.concatenate((knots1, knots2))
 
                 # make union basis for two segments to concatenate
                 basis_concat = BSplineBasis(knots_concat, degree[l])
@@ -391,9 +686,9 @@ def concat_splines(segments, segment_times, n_insert=None):
                 coeffs[l] = coeffs_concat
             else:
                 #there was no continuity, just compute new knot vector and stack coefficients
-                knots[l] = np.r_[
-                           knots[l], s.basis.knots[degree[l]+1:]*segment_times[k] + knots[l][-1]]
-                coeffs[l] = np.r_[coeffs[l], s.coeffs]
+                knots[l] = np.concatenate((
+                           knots[l], all_knots[l][k][degree[l]+1:]*segment_times[k] + knots[l][-1]))
+                coeffs[l] = np.concatenate((coeffs[l], all_coeffs[l][k]))
         # going to next segment, update time shift
         new_bases = [BSplineBasis(knots[l], degree[l])for l in range(len(segments[0]))]
         prev_segment = [BSpline(new_bases[l], coeffs[l]) for l in range(len(segments[0]))]
@@ -405,6 +700,17 @@ def concat_splines(segments, segment_times, n_insert=None):
 
 def sample_splines(spline, time):
     if isinstance(spline, list):
+        # when all splines share the same (instance-cached) basis, the knot
+        # intervals of the sample points are located only once: evaluate the
+        # basis in a single batched call and reuse it for every spline
+        basis = spline[0].basis
+        t = np.asarray(time)
+        if (len(spline) > 1 and hasattr(interpolate.BSpline, 'design_matrix')
+                and all(s.basis is basis for s in spline[1:])
+                and t.ndim == 1 and t.size > 0
+                and t.min() >= basis.knots[0] and t.max() <= basis.knots[-1]):
+            B = interpolate.BSpline.design_matrix(t, basis.knots, basis.degree)
+            return [B.dot(s.coeffs) for s in spline]
         return [splev(time, (s.basis.knots, s.coeffs, s.basis.degree)) for s in spline]
     else:
         return splev(time, (spline.basis.knots, spline.coeffs, spline.basis.degree))